@@ -0,0 +1,78 @@
+import asyncio
+import database as db
+
+# Async wrappers around the blocking sqlite3 calls in database.py.
+# Each call runs in asyncio's default thread pool; database.get_db_connection() keeps one
+# connection per thread, so the worker threads never share a sqlite3 connection.
+
+async def set_user_state(user_id: int, state: str | None):
+    """Sets the state for a given user without blocking the event loop."""
+    await asyncio.to_thread(db.set_user_state, user_id, state)
+
+async def get_user_state(user_id: int) -> str | None:
+    """Gets the current state for a given user without blocking the event loop."""
+    return await asyncio.to_thread(db.get_user_state, user_id)
+
+async def set_base_group(user_id: int, group_id: int, group_name: str):
+    """Sets the base group for a user without blocking the event loop."""
+    await asyncio.to_thread(db.set_base_group, user_id, group_id, group_name)
+
+async def get_base_group(user_id: int) -> tuple[int, str] | None:
+    """Gets the base group ID and name for a user without blocking the event loop."""
+    return await asyncio.to_thread(db.get_base_group, user_id)
+
+async def clear_base_group(user_id: int):
+    """Clears the base group for a user without blocking the event loop."""
+    await asyncio.to_thread(db.clear_base_group, user_id)
+
+async def add_destination_group(user_id: int, group_id: int, group_name: str):
+    """Adds a destination group for a user without blocking the event loop."""
+    await asyncio.to_thread(db.add_destination_group, user_id, group_id, group_name)
+
+async def remove_destination_group(user_id: int, group_id: int) -> bool:
+    """Removes a specific destination group for a user without blocking the event loop."""
+    return await asyncio.to_thread(db.remove_destination_group, user_id, group_id)
+
+async def get_destination_groups(user_id: int) -> list[tuple[int, str]]:
+    """Gets all destination group IDs and names for a user without blocking the event loop."""
+    return await asyncio.to_thread(db.get_destination_groups, user_id)
+
+async def get_destination_rules(user_id: int) -> list[tuple[int, str, bool, bool]]:
+    """Gets all destination groups with their copy/active flags without blocking the event loop."""
+    return await asyncio.to_thread(db.get_destination_rules, user_id)
+
+async def toggle_destination_copy_mode(user_id: int, group_id: int) -> bool | None:
+    """Switches a destination between forwarding and copying without blocking the event loop."""
+    return await asyncio.to_thread(db.toggle_destination_copy_mode, user_id, group_id)
+
+async def get_all_forwarding_configs() -> dict[int, list[tuple[int, bool]]]:
+    """Gets the base_group_id -> (dest_group_id, copy_messages) map without blocking the event loop."""
+    return await asyncio.to_thread(db.get_all_forwarding_configs)
+
+async def check_destination_conflict(base_group_id: int, dest_group_id: int) -> bool:
+    """Checks whether any user already forwards base -> dest without blocking the event loop."""
+    return await asyncio.to_thread(db.check_destination_conflict, base_group_id, dest_group_id)
+
+async def reactivate_destination_group(user_id: int, group_id: int) -> bool:
+    """Re-enables a deactivated destination without blocking the event loop."""
+    return await asyncio.to_thread(db.reactivate_destination_group, user_id, group_id)
+
+async def deactivate_forwarding(base_group_id: int, dest_group_id: int) -> list[tuple[int, str]]:
+    """Marks a base -> destination rule inactive for all users without blocking the event loop."""
+    return await asyncio.to_thread(db.deactivate_forwarding, base_group_id, dest_group_id)
+
+async def upsert_known_chat(chat_id: int, chat_title: str, chat_type: str):
+    """Stores or updates a known chat without blocking the event loop."""
+    await asyncio.to_thread(db.upsert_known_chat, chat_id, chat_title, chat_type)
+
+async def load_known_chats() -> dict[int, str]:
+    """Gets all active known chats without blocking the event loop."""
+    return await asyncio.to_thread(db.load_known_chats)
+
+async def set_user_authenticated(user_id: int, authenticated: bool = True):
+    """Sets the authentication status for a user without blocking the event loop."""
+    await asyncio.to_thread(db.set_user_authenticated, user_id, authenticated)
+
+async def is_user_authenticated(user_id: int) -> bool:
+    """Checks if a user is authenticated without blocking the event loop."""
+    return await asyncio.to_thread(db.is_user_authenticated, user_id)
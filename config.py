@@ -10,4 +10,11 @@ ACCESS_PASSWORD = os.getenv("ACCESS_PASSWORD", "password123")  # Default passwor
 if not TELEGRAM_BOT_TOKEN:
     raise ValueError("No TELEGRAM_BOT_TOKEN found in environment variables. Make sure to set it in the .env file.")
 
-DATABASE_NAME = "forwarder_bot.sqlite3" 
\ No newline at end of file
+DATABASE_NAME = "forwarder_bot.sqlite3"
+
+# Max forward/copy API calls in flight at once (matches the default HTTPXRequest connection pool)
+MAX_CONCURRENT_TELEGRAM_CALLS = int(os.getenv("MAX_CONCURRENT_TELEGRAM_CALLS", "20")) 
+
+# Updates processed at once; each user's own updates still run one at a time (see handlers.PerUserUpdateProcessor).
+# Updates waiting for their user's previous one hold a slot, so leave headroom for users sending bursts.
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "32"))
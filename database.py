@@ -26,6 +26,8 @@ def initialize_database():
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
+        # WAL lets the per-thread connections (see async_db) read while another thread writes
+        cursor.execute("PRAGMA journal_mode=WAL")
         # User configuration: stores base group and current state
         cursor.execute("""
             CREATE TABLE IF NOT EXISTS users_config (
@@ -42,10 +44,19 @@ def initialize_database():
                 user_id INTEGER NOT NULL,
                 dest_group_id INTEGER NOT NULL,
                 dest_group_name TEXT,
+                copy_messages BOOLEAN DEFAULT FALSE, -- Send copies (no "Forwarded from" header) instead of forwards
+                is_active BOOLEAN DEFAULT TRUE, -- FALSE once the bot repeatedly failed to post there; the user can reactivate it
                 FOREIGN KEY (user_id) REFERENCES users_config (user_id) ON DELETE CASCADE,
                 UNIQUE (user_id, dest_group_id) -- Each user can only add a destination once
             )
         """)
+        # Databases created before copy_messages/is_active existed need the columns added
+        cursor.execute("PRAGMA table_info(destination_groups)")
+        existing_columns = [row['name'] for row in cursor.fetchall()]
+        if 'copy_messages' not in existing_columns:
+            cursor.execute("ALTER TABLE destination_groups ADD COLUMN copy_messages BOOLEAN DEFAULT FALSE")
+        if 'is_active' not in existing_columns:
+            cursor.execute("ALTER TABLE destination_groups ADD COLUMN is_active BOOLEAN DEFAULT TRUE")
         # Index for faster lookups, especially for conflict checking
         cursor.execute("""
             CREATE INDEX IF NOT EXISTS idx_dest_group_id ON destination_groups (dest_group_id);
@@ -173,33 +184,77 @@ def get_destination_groups(user_id: int) -> list[tuple[int, str]]:
     cursor.execute("SELECT dest_group_id, dest_group_name FROM destination_groups WHERE user_id = ?", (user_id,))
     return [(row['dest_group_id'], row['dest_group_name']) for row in cursor.fetchall()]
 
-def get_all_forwarding_configs() -> dict[int, list[int]]:
+def get_destination_rules(user_id: int) -> list[tuple[int, str, bool, bool]]:
+    """Gets all destination groups for a user along with their copy_messages and is_active flags."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT dest_group_id, dest_group_name, copy_messages, is_active FROM destination_groups WHERE user_id = ?", (user_id,))
+    return [(row['dest_group_id'], row['dest_group_name'], bool(row['copy_messages']), bool(row['is_active']))
+            for row in cursor.fetchall()]
+
+def reactivate_destination_group(user_id: int, group_id: int) -> bool:
+    """Re-enables a destination deactivated after delivery failures. Returns True if it was inactive."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        UPDATE destination_groups SET is_active = TRUE
+        WHERE user_id = ? AND dest_group_id = ? AND NOT is_active
+    """, (user_id, group_id))
+    conn.commit()
+    if cursor.rowcount > 0:
+        logger.info(f"User {user_id} reactivated destination group {group_id}")
+        return True
+    return False
+
+def toggle_destination_copy_mode(user_id: int, group_id: int) -> bool | None:
+    """Switches a destination between forwarding and copying. Returns the new copy flag, or None if not found."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        UPDATE destination_groups SET copy_messages = NOT copy_messages
+        WHERE user_id = ? AND dest_group_id = ?
+    """, (user_id, group_id))
+    conn.commit()
+    if cursor.rowcount == 0:
+        logger.warning(f"User {user_id} tried to toggle copy mode of non-existent destination group {group_id}")
+        return None
+    cursor.execute("SELECT copy_messages FROM destination_groups WHERE user_id = ? AND dest_group_id = ?", (user_id, group_id))
+    copy_messages = bool(cursor.fetchone()['copy_messages'])
+    logger.info(f"User {user_id} set copy mode of destination group {group_id} to {copy_messages}")
+    return copy_messages
+
+def get_all_forwarding_configs() -> dict[int, list[tuple[int, bool]]]:
     """
-    Gets a dictionary mapping base_group_id to a list of destination_group_ids
-    across all users. Used for efficient message forwarding lookup.
-    Returns: dict[base_group_id, list[dest_group_id]]
+    Gets a dictionary mapping base_group_id to a list of (destination_group_id, copy_messages)
+    across all authenticated users. Used for efficient message forwarding lookup.
+    Returns: dict[base_group_id, list[(dest_group_id, copy_messages)]]
     """
     configs = {}
     conn = get_db_connection()
     cursor = conn.cursor()
-    # Get all users with a configured base group
-    cursor.execute("SELECT user_id, base_group_id FROM users_config WHERE base_group_id IS NOT NULL")
+    # Get all authenticated users with a configured base group
+    cursor.execute("""
+        SELECT uc.user_id, uc.base_group_id
+        FROM users_config uc
+        JOIN authenticated_users au ON au.user_id = uc.user_id AND au.authenticated
+        WHERE uc.base_group_id IS NOT NULL
+    """)
     users_with_base = cursor.fetchall()
 
     for user_row in users_with_base:
         user_id = user_row['user_id']
         base_group_id = user_row['base_group_id']
         # Get destination groups for this user
-        cursor.execute("SELECT dest_group_id FROM destination_groups WHERE user_id = ?", (user_id,))
-        dest_groups = [row['dest_group_id'] for row in cursor.fetchall()]
+        cursor.execute("SELECT dest_group_id, copy_messages FROM destination_groups WHERE user_id = ? AND is_active", (user_id,))
+        dest_groups = [(row['dest_group_id'], bool(row['copy_messages'])) for row in cursor.fetchall()]
         if dest_groups: # Only add if there are destinations
             if base_group_id not in configs:
                 configs[base_group_id] = []
             # Add only unique destination IDs for this base group across all users
             # (Shouldn't happen with current logic, but good practice)
-            for dest_id in dest_groups:
-                 if dest_id not in configs[base_group_id]:
-                     configs[base_group_id].append(dest_id)
+            for dest_id, copy_messages in dest_groups:
+                 if all(dest_id != existing_id for existing_id, _ in configs[base_group_id]):
+                     configs[base_group_id].append((dest_id, copy_messages))
 
     return configs
 
@@ -230,6 +285,50 @@ def check_destination_conflict(base_group_id_to_check: int, dest_group_id_to_che
 
     return cursor.fetchone() is not None # Conflict exists if a row is found
 
+def deactivate_forwarding(base_group_id: int, dest_group_id: int) -> list[tuple[int, str]]:
+    """
+    Marks dest_group_id inactive for every user whose base group is base_group_id.
+    Used when the bot can no longer post to that destination; the rules are kept so users can reactivate them.
+    Returns (user_id, dest_group_name) for each rule that was active until now.
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT dg.user_id, dg.dest_group_name FROM destination_groups dg
+        JOIN users_config uc ON uc.user_id = dg.user_id
+        WHERE uc.base_group_id = ? AND dg.dest_group_id = ? AND dg.is_active
+    """, (base_group_id, dest_group_id))
+    affected = [(row['user_id'], row['dest_group_name']) for row in cursor.fetchall()]
+    if affected:
+        cursor.execute("""
+            UPDATE destination_groups SET is_active = FALSE
+            WHERE dest_group_id = ? AND user_id IN (SELECT user_id FROM users_config WHERE base_group_id = ?)
+        """, (dest_group_id, base_group_id))
+        conn.commit()
+        logger.info(f"Deactivated forwarding {base_group_id} -> {dest_group_id} for users {[user_id for user_id, _ in affected]}")
+    return affected
+
+def upsert_known_chat(chat_id: int, chat_title: str, chat_type: str):
+    """Stores a group/channel the bot has seen, or updates its title and type."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        INSERT INTO known_chats (chat_id, chat_title, chat_type) VALUES (?, ?, ?)
+        ON CONFLICT (chat_id) DO UPDATE SET
+            chat_title = excluded.chat_title,
+            chat_type = excluded.chat_type,
+            last_activity = CURRENT_TIMESTAMP,
+            is_active = TRUE
+    """, (chat_id, chat_title, str(chat_type)))
+    conn.commit()
+
+def load_known_chats() -> dict[int, str]:
+    """Gets all active known chats as {chat_id: chat_title}, least recently updated first."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT chat_id, chat_title FROM known_chats WHERE is_active ORDER BY last_activity")
+    return {row['chat_id']: row['chat_title'] for row in cursor.fetchall()}
+
 def set_user_authenticated(user_id: int, authenticated: bool = True):
     """Sets the authentication status for a user."""
     conn = get_db_connection()
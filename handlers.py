@@ -1,8 +1,19 @@
+import asyncio
+import bisect
+import collections
+import datetime as dt
+import functools
+import hmac
 import logging
+import operator
+import secrets
+import time
+import weakref
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, constants
-from telegram.ext import ContextTypes, ConversationHandler
-import database as db
-import math # Add math import for ceiling division
+from telegram.error import TelegramError, RetryAfter, Forbidden, BadRequest
+from telegram.ext import BaseUpdateProcessor, ContextTypes, ConversationHandler
+from cachetools import TTLCache
+import async_db
 import config # Import config to access ACCESS_PASSWORD
 
 logger = logging.getLogger(__name__)
@@ -11,6 +22,35 @@ logger = logging.getLogger(__name__)
 CHATS_PER_PAGE = 5
 CALLBACK_PREFIX_BASE = 'sel_base'
 CALLBACK_PREFIX_DEST = 'sel_dest'
+_CONFIG_TTL = 30.0 # Seconds the cached forwarding map is trusted before reloading from the DB
+_BATCH_WINDOW = 0.2 # Seconds to wait for more messages before flushing a forward batch
+_BATCH_MAX = 100 # forwardMessages accepts at most 100 message IDs per call
+_DEAD_DEST_MAX_FAILURES = 3 # Consecutive Forbidden/chat-not-found errors tolerated before a rule is deactivated
+_TG_SEMA = asyncio.Semaphore(config.MAX_CONCURRENT_TELEGRAM_CALLS) # Caps outbound forward/copy calls in flight
+_GROUPISH_CHAT_TYPES = frozenset({constants.ChatType.GROUP, constants.ChatType.SUPERGROUP, constants.ChatType.CHANNEL})
+_SORTED_CHAT_KEY = operator.itemgetter(2) # bot_data['sorted_chats'] entries are (chat_id, chat_name, lower_name)
+_MEMBER_CACHE_TTL = 60.0 # Seconds a get_chat_member result for the bot is reused
+_NOT_MEMBER_STATUSES = frozenset({constants.ChatMemberStatus.LEFT, constants.ChatMemberStatus.BANNED})
+_PASSWORD_BYTES = config.ACCESS_PASSWORD.encode() # Encoded once for hmac.compare_digest
+_KB_CACHE_MAX = 64 # Group selection keyboards kept per (prefix, page, known chats version)
+_CHAT_LIST_EPOCH = secrets.token_hex(3) # New on every start: selection buttons from an earlier run never resolve
+MAX_KNOWN_CHATS = 5000 # Least recently active chats beyond this are dropped from the selection list
+
+# Welcome text shown after /start; only the user mention changes between calls
+WELCOME_TEMPLATE = (
+    "¡Hola {mention}! 👋\n\n"
+    "Soy tu asistente para reenviar mensajes entre grupos de Telegram.\n\n"
+    "<b>¿Cómo funciona?</b>\n"
+    "1. <b>Añádeme</b> a los grupos que quieres usar (el grupo 'base' de donde leeré los mensajes y los grupos 'destino' a donde los enviaré).\n"
+    "2. Usa el menú de abajo para <b>configurar</b> cuál es tu grupo base y cuáles son tus grupos destino.\n"
+    "   - Para configurar un grupo, deberás <b>reenviarme un mensaje cualquiera</b> de ese grupo.\n"
+    "3. Una vez configurado, reenviaré automáticamente los mensajes del grupo base a los grupos destino.\n\n"
+    "<b>Importante:</b>\n"
+    "- Solo puedo leer/reenviar mensajes si estoy en los grupos y tengo permisos.\n"
+    "- Cada usuario tiene su propia configuración independiente.\n"
+    "- No se permite que dos configuraciones distintas usen el mismo grupo base para reenviar al <i>mismo</i> grupo destino.\n\n"
+    "Usa los botones de abajo para empezar:"
+)
 
 # States for ConversationHandler
 AWAITING_PASSWORD = 1
@@ -19,20 +59,228 @@ AWAITING_PASSWORD = 1
 # We'll primarily use db.get_user_state for simpler logic flow here
 
 # --- Helper Function ---
-def add_known_chat(context: ContextTypes.DEFAULT_TYPE, chat_id: int, chat_title: str):
-    """Stores or updates chat info in bot_data."""
-    if 'known_chats' not in context.bot_data:
-        context.bot_data['known_chats'] = {}
-    # Store chat info (could potentially store more details later if needed)
-    context.bot_data['known_chats'][chat_id] = chat_title
-    logger.debug(f"Added/Updated known chat: {chat_id} - {chat_title}")
+def add_known_chat(context: ContextTypes.DEFAULT_TYPE, chat_id: int, chat_title: str, chat_type: str):
+    """Stores or updates chat info in bot_data and persists it in the background."""
+    # Ordered by activity (most recent last), so the least recently active chat is evicted first
+    known_chats = context.bot_data.setdefault('known_chats', collections.OrderedDict())
+    old_title = known_chats.get(chat_id)
+    if old_title is not None:
+        known_chats.move_to_end(chat_id)
+        # Nothing else to do for a chat already known under the same title, the case for almost every message
+        if old_title == chat_title:
+            return
+    # Store chat info keyed by id only, so a renamed chat just updates its title
+    known_chats[chat_id] = chat_title
+
+    # Keep the name-sorted list used by the selection keyboards in order
+    sorted_chats = context.bot_data.setdefault('sorted_chats', [])
+    if old_title is not None:
+        _remove_sorted_chat(sorted_chats, chat_id, old_title)
+    elif len(known_chats) > MAX_KNOWN_CHATS:
+        evicted_id, evicted_title = known_chats.popitem(last=False)
+        _remove_sorted_chat(sorted_chats, evicted_id, evicted_title)
+    bisect.insort(sorted_chats, (chat_id, chat_title, chat_title.lower()), key=_SORTED_CHAT_KEY)
+    # Selection keyboards built for older versions of the list are no longer used
+    context.bot_data['known_chats_version'] = context.bot_data.get('known_chats_version', 0) + 1
+    # Only new or renamed chats reach this point, so the DB sees one write per change, not per message
+    context.application.create_task(async_db.upsert_known_chat(chat_id, chat_title, chat_type))
+    logger.debug("Added/Updated known chat: %s - %s", chat_id, chat_title)
+
+def _remove_sorted_chat(sorted_chats: list[tuple[int, str, str]], chat_id: int, chat_title: str):
+    i = bisect.bisect_left(sorted_chats, chat_title.lower(), key=_SORTED_CHAT_KEY)
+    while sorted_chats[i][0] != chat_id: # Skip other chats sharing the same name
+        i += 1
+    del sorted_chats[i]
+
+async def load_known_chats(application) -> None:
+    """Seeds known_chats and the sorted list from the DB, so selection keyboards work right after a restart."""
+    # Rows come least recently added/renamed first (last_activity is only written on those changes),
+    # so after a restart the LRU starts from that order; keep the most recently added/renamed MAX_KNOWN_CHATS
+    known_chats = collections.OrderedDict(list((await async_db.load_known_chats()).items())[-MAX_KNOWN_CHATS:])
+    application.bot_data['known_chats'] = known_chats
+    application.bot_data['sorted_chats'] = sorted(
+        ((chat_id, title, title.lower()) for chat_id, title in known_chats.items()),
+        key=_SORTED_CHAT_KEY
+    )
+    application.bot_data['known_chats_version'] = application.bot_data.get('known_chats_version', 0) + 1
+    logger.info(f"Loaded {len(known_chats)} known chats from the database.")
+
+_config_reload_lock = asyncio.Lock() # Lets a single coroutine reload the forwarding map at a time
+
+def _config_cache_fresh(cached: tuple[float, dict] | None) -> bool:
+    return cached is not None and time.monotonic() - cached[0] <= _CONFIG_TTL
+
+async def _get_configs_cached(context: ContextTypes.DEFAULT_TYPE) -> dict[int, tuple[tuple[int, bool], ...]]:
+    """Returns the forwarding map, reloading it from the DB once the TTL has expired."""
+    bot_data = context.application.bot_data
+    cached = bot_data.get('_fwd_cache')
+    if _config_cache_fresh(cached):
+        return cached[1]
+    async with _config_reload_lock:
+        cached = bot_data.get('_fwd_cache')
+        if not _config_cache_fresh(cached): # Another message may have reloaded it meanwhile
+            configs = await async_db.get_all_forwarding_configs()
+            # Destinations are stored as immutable tuples, they are only ever iterated
+            cached = (time.monotonic(), {src: tuple(dests) for src, dests in configs.items()})
+            bot_data['_fwd_cache'] = cached
+            # Set of configured base chats, used to drop non-source chats with a single probe
+            bot_data['_fwd_base_ids'] = frozenset(cached[1])
+    return cached[1]
+
+def invalidate_forwarding_cache(context: ContextTypes.DEFAULT_TYPE):
+    """Drops the cached forwarding map so the next group message reloads it."""
+    context.application.bot_data.pop('_fwd_cache', None)
+
+async def check_membership(context: ContextTypes.DEFAULT_TYPE, chat_id: int) -> str | None:
+    """Returns the bot's member status in a chat (cached briefly), or None if it couldn't be checked."""
+    member_cache = context.bot_data.setdefault('member_cache', {})
+    cached = member_cache.get(chat_id)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+    try:
+        logger.debug(f"Attempting get_chat_member for chat {chat_id} (bot ID: {context.bot.id})")
+        bot_member = await context.bot.get_chat_member(chat_id, context.bot.id)
+    except TelegramError as e:
+        logger.error(f"Error during get_chat_member for {chat_id}: {e!r}")
+        return None
+    logger.info(f"Bot membership status in {chat_id}: {bot_member.status}")
+    member_cache[chat_id] = (time.monotonic() + _MEMBER_CACHE_TTL, bot_member.status)
+    return bot_member.status
+
+async def is_authenticated(context: ContextTypes.DEFAULT_TYPE, user_id: int) -> bool:
+    """Checks the user's auth flag, hitting the DB only until it has been seen as true once per user."""
+    if context.user_data.get('authed'):
+        return True
+    authed = await async_db.is_user_authenticated(user_id)
+    if authed:
+        context.user_data['authed'] = True
+    return authed
+
+# --- Forward Batching ---
+def _enqueue_forward(context: ContextTypes.DEFAULT_TYPE, from_chat_id: int, dest_id: int, copy_messages: bool, message_id: int):
+    """Queues a message for forwarding, starting the batch worker for the (source, dest, mode) rule if needed."""
+    queues = context.application.bot_data.setdefault('_fwd_queues', {})
+    key = (from_chat_id, dest_id, copy_messages)
+    queue = queues.get(key)
+    if queue is None:
+        queue = queues[key] = asyncio.Queue()
+        context.application.create_task(_forward_worker(context.application, key, queue))
+    queue.put_nowait(message_id)
+
+async def _forward_worker(application, key: tuple[int, int, bool], queue: asyncio.Queue):
+    """Drains a (source, dest, mode) queue in batches of up to _BATCH_MAX messages, then exits."""
+    from_chat_id, dest_id, copy_messages = key
+    loop = asyncio.get_running_loop()
+    try:
+        while not queue.empty():
+            message_ids = [queue.get_nowait()]
+            deadline = loop.time() + _BATCH_WINDOW
+            # Collect whatever else arrives within the window
+            while len(message_ids) < _BATCH_MAX:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    message_ids.append(await asyncio.wait_for(queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                await _flush_forward_batch(application, from_chat_id, dest_id, copy_messages, message_ids)
+            except Exception:
+                # Only this batch is lost; the worker keeps draining what is still queued
+                logger.exception("Unexpected error flushing %d message(s) from %s to %s", len(message_ids), from_chat_id, dest_id)
+    finally:
+        # No await between the empty check and here, so nothing can be queued in between
+        application.bot_data['_fwd_queues'].pop(key, None)
+
+async def _send_forward_batch(bot, from_chat_id: int, dest_id: int, copy_messages: bool, message_ids: list[int]):
+    """Forwards (or copies) a batch with a single API call, using the plural method for several messages."""
+    async with _TG_SEMA:
+        if len(message_ids) == 1:
+            send_one = bot.copy_message if copy_messages else bot.forward_message
+            await send_one(chat_id=dest_id, from_chat_id=from_chat_id, message_id=message_ids[0])
+        else:
+            # forwardMessages/copyMessages require strictly increasing message IDs
+            send_many = bot.copy_messages if copy_messages else bot.forward_messages
+            await send_many(chat_id=dest_id, from_chat_id=from_chat_id, message_ids=sorted(message_ids))
+
+async def _flush_forward_batch(application, from_chat_id: int, dest_id: int, copy_messages: bool, message_ids: list[int]):
+    """Sends a batch, retrying once on flood control and tracking destinations the bot can't post to."""
+    try:
+        try:
+            await _send_forward_batch(application.bot, from_chat_id, dest_id, copy_messages, message_ids)
+        except RetryAfter as e:
+            # Flood control: wait as long as Telegram asks and retry once
+            retry_after = e.retry_after
+            if isinstance(retry_after, dt.timedelta):
+                retry_after = retry_after.total_seconds()
+            logger.warning("Flood control forwarding to %s, retrying in %ss", dest_id, retry_after)
+            await asyncio.sleep(retry_after)
+            await _send_forward_batch(application.bot, from_chat_id, dest_id, copy_messages, message_ids)
+    except TelegramError as e:
+        if isinstance(e, Forbidden) or (isinstance(e, BadRequest) and 'chat not found' in e.message.lower()):
+            await _record_dead_destination(application, from_chat_id, dest_id, e)
+        else:
+            logger.error("Failed to forward %d message(s) %s from %s to %s: %s", len(message_ids), message_ids, from_chat_id, dest_id, e)
+            # TODO: Consider notifying the user if other errors keep recurring? (dead destinations already are)
+        return
+
+    # Any successful forward resets the failure streak for this pair
+    application.bot_data.get('_fwd_fails', {}).pop((from_chat_id, dest_id), None)
+    logger.info("Forwarded %d message(s) from %s to %s", len(message_ids), from_chat_id, dest_id)
+
+async def _record_dead_destination(application, from_chat_id: int, dest_id: int, error: TelegramError):
+    """Skips a destination the bot can't reach and deactivates the rule after repeated failures."""
+    fails = application.bot_data.setdefault('_fwd_fails', {})
+    key = (from_chat_id, dest_id)
+    fails[key] = fails.get(key, 0) + 1
+    logger.warning("Can't forward from %s to %s (%s), failure %d in a row", from_chat_id, dest_id, error, fails[key])
+    _evict_destination(application.bot_data, from_chat_id, dest_id)
+    if fails[key] > _DEAD_DEST_MAX_FAILURES:
+        del fails[key]
+        for user_id, dest_name in await async_db.deactivate_forwarding(from_chat_id, dest_id):
+            invalidate_user_menus(user_id)
+            try:
+                await application.bot.send_message(
+                    chat_id=user_id,
+                    text=f"⚠️ He desactivado el reenvío al grupo destino '{dest_name}': no puedo publicar en él ({error.message}).\n\n"
+                         f"Cuando vuelva a tener permisos, reactívalo desde \"Ver/Borrar Grupos Destino\"."
+                )
+            except TelegramError as e:
+                logger.warning("Couldn't notify user %s about deactivated destination %s: %s", user_id, dest_id, e)
+
+def _evict_destination(bot_data: dict, from_chat_id: int, dest_id: int):
+    """Removes a destination from the cached forwarding map (it comes back on the next reload)."""
+    cached = bot_data.get('_fwd_cache')
+    if cached and from_chat_id in cached[1]:
+        cached[1][from_chat_id] = tuple(rule for rule in cached[1][from_chat_id] if rule[0] != dest_id)
 
 # --- Menu Keyboard ---
-def get_main_menu_keyboard(user_id: int) -> InlineKeyboardMarkup:
-    """Generates the main menu keyboard based on current user config."""
-    base_group = db.get_base_group(user_id)
-    dest_groups = db.get_destination_groups(user_id)
+# Built keyboards per user_id; PTB never mutates a sent InlineKeyboardMarkup, so sharing is safe
+_menu_cache = TTLCache(maxsize=10_000, ttl=300)
+_dest_view_cache = TTLCache(maxsize=10_000, ttl=300)
+
+def invalidate_user_menus(user_id: int):
+    """Forgets the cached menus of a user whose base/destination groups changed."""
+    _menu_cache.pop(user_id, None)
+    _dest_view_cache.pop(user_id, None)
+
+async def get_main_menu_keyboard(user_id: int) -> InlineKeyboardMarkup:
+    """Generates the main menu keyboard based on current user config (cached per user)."""
+    markup = _menu_cache.get(user_id)
+    if markup is None:
+        markup = _menu_cache[user_id] = await _build_main_menu_keyboard(user_id)
+    return markup
+
+async def _build_main_menu_keyboard(user_id: int) -> InlineKeyboardMarkup:
+    base_group, dest_groups = await asyncio.gather(
+        async_db.get_base_group(user_id),
+        async_db.get_destination_groups(user_id)
+    )
+    return _main_menu_markup(base_group, len(dest_groups))
 
+def _main_menu_markup(base_group: tuple[int, str] | None, dest_count: int) -> InlineKeyboardMarkup:
+    """Builds the main menu for a given config; also used to show projected state before a DB write lands."""
     keyboard = []
     if base_group:
         base_group_id, base_group_name = base_group
@@ -40,8 +288,8 @@ def get_main_menu_keyboard(user_id: int) -> InlineKeyboardMarkup:
         keyboard.append([InlineKeyboardButton("❌ Limpiar Grupo Base", callback_data='clear_base')])
         # Only allow adding destinations if base is set
         keyboard.append([InlineKeyboardButton("➕ Añadir Grupo Destino", callback_data='add_dest')])
-        if dest_groups:
-            keyboard.append([InlineKeyboardButton(f"🗑️ Ver/Borrar Grupos Destino ({len(dest_groups)})", callback_data='view_dest')])
+        if dest_count:
+            keyboard.append([InlineKeyboardButton(f"🗑️ Ver/Borrar Grupos Destino ({dest_count})", callback_data='view_dest')])
     else:
         keyboard.append([InlineKeyboardButton("🎯 Establecer Grupo Base", callback_data='set_base')])
 
@@ -50,20 +298,87 @@ def get_main_menu_keyboard(user_id: int) -> InlineKeyboardMarkup:
 
     return InlineKeyboardMarkup(keyboard)
 
-def get_view_dest_keyboard(user_id: int) -> InlineKeyboardMarkup | None:
-    """Generates keyboard for viewing/deleting destination groups."""
-    dest_groups = db.get_destination_groups(user_id)
+async def get_view_dest_keyboard(user_id: int) -> tuple[InlineKeyboardMarkup | None, list[tuple[int, str, bool, bool]]]:
+    """
+    Generates keyboard for viewing/deleting destination groups (cached per user).
+    Returns the keyboard (None if there are no destinations) and the destination list it was built from.
+    """
+    cached = _dest_view_cache.get(user_id)
+    if cached is None:
+        cached = _dest_view_cache[user_id] = await _build_view_dest_keyboard(user_id)
+    return cached
+
+async def _build_view_dest_keyboard(user_id: int) -> tuple[InlineKeyboardMarkup | None, list[tuple[int, str, bool, bool]]]:
+    dest_groups = await async_db.get_destination_rules(user_id)
+    return _dest_view_markup(dest_groups), dest_groups
+
+def _dest_view_markup(dest_groups: list[tuple[int, str, bool, bool]]) -> InlineKeyboardMarkup | None:
+    """Builds the destination list keyboard (None if empty) from (id, name, copy_messages, is_active) rules."""
     if not dest_groups:
         return None
 
     keyboard = []
-    for group_id, group_name in dest_groups:
+    for group_id, group_name, copy_messages, is_active in dest_groups:
         # Using f-string for callback data; ensure parsing handles it
-        keyboard.append([InlineKeyboardButton(f"❌ Borrar: {group_name}", callback_data=f'delete_dest_{group_id}')])
+        if is_active:
+            mode_button = InlineKeyboardButton("📋 Modo: Copia" if copy_messages else "↪️ Modo: Reenvío", callback_data=f'toggle_copy_{group_id}')
+        else:
+            # Deactivated after repeated delivery failures
+            mode_button = InlineKeyboardButton("⏸️ Inactivo: Reactivar", callback_data=f'reactivate_dest_{group_id}')
+        keyboard.append([
+            InlineKeyboardButton(f"❌ Borrar: {group_name}", callback_data=f'delete_dest_{group_id}'),
+            mode_button,
+        ])
 
     keyboard.append([InlineKeyboardButton("🔙 Volver al Menú Principal", callback_data='main_menu')])
     return InlineKeyboardMarkup(keyboard)
 
+def _remember_menu(context: ContextTypes.DEFAULT_TYPE, markup: InlineKeyboardMarkup) -> InlineKeyboardMarkup:
+    """Records the main menu being shown to the user, for reuse by _fallback_menu."""
+    context.user_data['main_menu_markup'] = markup
+    return markup
+
+async def _main_menu(context: ContextTypes.DEFAULT_TYPE, user_id: int) -> InlineKeyboardMarkup:
+    """The user's current main menu, recorded for _fallback_menu. Use for every main menu sent outside error paths."""
+    return _remember_menu(context, await get_main_menu_keyboard(user_id))
+
+async def _fallback_menu(context: ContextTypes.DEFAULT_TYPE, user_id: int) -> InlineKeyboardMarkup:
+    """
+    Main menu for error replies: the last one shown to the user if any, so these paths
+    don't depend on the DB, which may be what just failed.
+    """
+    markup = context.user_data.get('main_menu_markup')
+    return markup if markup is not None else await get_main_menu_keyboard(user_id)
+
+# --- Optimistic Updates ---
+async def _persist_or_rollback(context: ContextTypes.DEFAULT_TYPE, query, user_id: int, write, failure_text: str):
+    """
+    Runs a config write once the message already shows its outcome.
+    Called after the optimistic edit, so a rollback edit can never be overwritten by it, and awaited
+    by the handler, so the user's next update sees the written config.
+    If the write fails, the message is edited back to the menu built from the DB.
+    """
+    try:
+        await write
+    except Exception as e:
+        if isinstance(e, ValueError): # Expected rejections from database.py (duplicates, group in use)
+            logger.warning(f"[User:{user_id}] Optimistic update rolled back: {e}")
+            text = f"⚠️ {failure_text}: {e}"
+        else:
+            logger.error(f"[User:{user_id}] Optimistic update failed, rolling back: {e}", exc_info=True)
+            text = f"❌ {failure_text}. Ocurrió un error inesperado."
+        invalidate_user_menus(user_id)
+        try:
+            await async_db.set_user_state(user_id, 'idle')
+            await query.edit_message_text(
+                text=f"{text}\n\nMenú Principal:",
+                reply_markup=await _main_menu(context, user_id)
+            )
+        except Exception as rollback_error:
+            logger.error(f"[User:{user_id}] Could not show rollback menu: {rollback_error}")
+    finally:
+        invalidate_forwarding_cache(context)
+
 # --- Group Selection Keyboard ---
 def get_group_selection_keyboard(
     context: ContextTypes.DEFAULT_TYPE, 
@@ -71,29 +386,44 @@ def get_group_selection_keyboard(
     page: int = 0
 ) -> InlineKeyboardMarkup | None:
     """Generates a keyboard with known chats for selection, with pagination."""
-    known_chats = context.bot_data.get('known_chats', {})
-    if not known_chats:
+    # Chats sorted by name, maintained by add_known_chat
+    sorted_chats = context.bot_data.get('sorted_chats', [])
+    if not sorted_chats:
         return None # No known chats to show
 
-    # Sort chats by name for consistent order (optional)
-    sorted_chat_items = sorted(known_chats.items(), key=lambda item: item[1].lower())
-    chat_ids = [item[0] for item in sorted_chat_items]
-    chat_names = [item[1] for item in sorted_chat_items]
-
-    total_chats = len(chat_ids)
-    total_pages = math.ceil(total_chats / CHATS_PER_PAGE)
+    total_chats = len(sorted_chats)
+    total_pages = -(-total_chats // CHATS_PER_PAGE) # Ceiling division in integer arithmetic
     page = max(0, min(page, total_pages - 1)) # Clamp page number
 
+    # The keyboard only depends on the page and the chat list, so it is shared by all users
+    kb_cache = context.bot_data.setdefault('kb_cache', collections.OrderedDict())
+    version = context.bot_data.get('known_chats_version', 0)
+    cache_key = (action_prefix, page, version)
+    markup = kb_cache.get(cache_key)
+    if markup is None:
+        markup = kb_cache[cache_key] = _build_group_selection_keyboard(sorted_chats, action_prefix, page, total_pages, version)
+        if len(kb_cache) > _KB_CACHE_MAX:
+            kb_cache.popitem(last=False)
+    else:
+        kb_cache.move_to_end(cache_key)
+    return markup
+
+def _build_group_selection_keyboard(
+    sorted_chats: list[tuple[int, str, str]],
+    action_prefix: str,
+    page: int,
+    total_pages: int,
+    version: int
+) -> InlineKeyboardMarkup:
     start_index = page * CHATS_PER_PAGE
     end_index = start_index + CHATS_PER_PAGE
-    chats_on_page = chat_ids[start_index:end_index]
-    names_on_page = chat_names[start_index:end_index]
 
     keyboard = []
-    for chat_id, chat_name in zip(chats_on_page, names_on_page):
+    for index, (chat_id, chat_name, _) in enumerate(sorted_chats[start_index:end_index], start_index):
         # Shorten long names if necessary
         display_name = chat_name if len(chat_name) < 50 else chat_name[:47] + '...'
-        keyboard.append([InlineKeyboardButton(display_name, callback_data=f'{action_prefix}_select_{chat_id}')])
+        # Buttons carry the chat's position in sorted_chats plus the process epoch and list version instead of the full chat id
+        keyboard.append([InlineKeyboardButton(display_name, callback_data=f'{action_prefix}_select_{_CHAT_LIST_EPOCH}:{version}.{index}')])
 
     # Pagination controls
     nav_row = []
@@ -110,6 +440,65 @@ def get_group_selection_keyboard(
 
     return InlineKeyboardMarkup(keyboard)
 
+def _resolve_chat_pick(context: ContextTypes.DEFAULT_TYPE, arg: str) -> tuple[int, str] | None:
+    """
+    Maps the '<epoch>:<version>.<index>' argument of a selection button back to (chat_id, chat_name).
+    Returns None if the keyboard was built by an earlier run of the bot or for an older chat list,
+    as the index may point to another chat now. Raises ValueError on malformed data.
+    """
+    epoch, _, position = arg.rpartition(':')
+    if epoch != _CHAT_LIST_EPOCH: # The version counter restarts with the process, so it can't tell runs apart
+        return None
+    version, _, index = position.partition('.')
+    version, index = int(version), int(index)
+    sorted_chats = context.bot_data.get('sorted_chats', [])
+    if version != context.bot_data.get('known_chats_version', 0) or not 0 <= index < len(sorted_chats):
+        return None
+    chat_id, chat_name, _ = sorted_chats[index]
+    return chat_id, chat_name
+
+async def _show_changed_selection(query, context: ContextTypes.DEFAULT_TYPE, action_prefix: str, user_id: int):
+    """Shows the selection list again after a pick from an outdated keyboard."""
+    keyboard = get_group_selection_keyboard(context, action_prefix, page=0)
+    await query.edit_message_text(
+        text="La lista de grupos ha cambiado. Selecciona de nuevo:",
+        reply_markup=keyboard or await _main_menu(context, user_id)
+    )
+
+# --- Per-User Serialisation ---
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Processes updates of different users concurrently while each user's updates run one by one,
+    in arrival order. The whole update is serialised, including the ConversationHandler's own
+    state change, which PTB relies on happening update by update.
+    """
+    __slots__ = ("_user_locks",)
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        # Locks disappear once no update of that user is queued or running
+        self._user_locks: weakref.WeakValueDictionary[int, asyncio.Lock] = weakref.WeakValueDictionary()
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None: # Channel posts, polls, ...: nothing to keep in order
+            await coroutine
+            return
+        lock = self._user_locks.get(user.id)
+        if lock is None:
+            lock = self._user_locks[user.id] = asyncio.Lock()
+        # Runs inside one of the max_concurrent_updates slots: updates queued behind a user's lock
+        # keep their slot while waiting, so a single busy user can occupy several of them
+        # (size MAX_CONCURRENT_UPDATES with that in mind)
+        async with lock:
+            await coroutine
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
 # --- Command Handlers ---
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Handles the /start command, prompts for password if not authenticated."""
@@ -118,7 +507,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     logger.info(f"User {user_id} ({user.username}) started the bot.")
 
     # Check if user is already authenticated
-    if db.is_user_authenticated(user_id):
+    if await is_authenticated(context, user_id):
         return await show_main_menu(update, context)
     else:
         # Ask for password
@@ -134,10 +523,12 @@ async def verify_password(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     user_id = update.effective_user.id
     password_attempt = update.message.text
     
-    # Check if password is correct
-    if password_attempt == config.ACCESS_PASSWORD:
+    # Check if password is correct (constant time, so response timing doesn't leak matching prefixes)
+    if hmac.compare_digest(password_attempt.encode(), _PASSWORD_BYTES):
         # Mark user as authenticated
-        db.set_user_authenticated(user_id, True)
+        await async_db.set_user_authenticated(user_id, True)
+        context.user_data['authed'] = True
+        invalidate_forwarding_cache(context)
         await update.message.reply_text("¡Contraseña correcta! Ahora puedes usar el bot.")
         return await show_main_menu(update, context)
     else:
@@ -151,356 +542,419 @@ async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     user_id = user.id
 
     # Ensure user exists in DB, set state to idle if new
-    if db.get_user_state(user_id) is None:
-         db.set_user_state(user_id, 'idle')
-
-    welcome_message = (
-        f"¡Hola {user.mention_html()}! 👋\n\n"
-        f"Soy tu asistente para reenviar mensajes entre grupos de Telegram.\n\n"
-        f"<b>¿Cómo funciona?</b>\n"
-        f"1. <b>Añádeme</b> a los grupos que quieres usar (el grupo 'base' de donde leeré los mensajes y los grupos 'destino' a donde los enviaré).\n"
-        f"2. Usa el menú de abajo para <b>configurar</b> cuál es tu grupo base y cuáles son tus grupos destino.\n"
-        f"   - Para configurar un grupo, deberás <b>reenviarme un mensaje cualquiera</b> de ese grupo.\n"
-        f"3. Una vez configurado, reenviaré automáticamente los mensajes del grupo base a los grupos destino.\n\n"
-        f"<b>Importante:</b>\n"
-        f"- Solo puedo leer/reenviar mensajes si estoy en los grupos y tengo permisos.\n"
-        f"- Cada usuario tiene su propia configuración independiente.\n"
-        f"- No se permite que dos configuraciones distintas usen el mismo grupo base para reenviar al <i>mismo</i> grupo destino.\n\n"
-        f"Usa los botones de abajo para empezar:"
-    )
+    if await async_db.get_user_state(user_id) is None:
+         await async_db.set_user_state(user_id, 'idle')
+
+    welcome_message = WELCOME_TEMPLATE.format(mention=user.mention_html())
 
     await update.message.reply_html(
         text=welcome_message,
-        reply_markup=get_main_menu_keyboard(user_id),
+        reply_markup=await _main_menu(context, user_id),
         disable_web_page_preview=True
     )
     return ConversationHandler.END
 
 # --- Callback Query Handlers ---
-async def button_callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Handles all button presses from inline keyboards."""
-    query = update.callback_query
-    await query.answer() # Acknowledge the button press
-    user_id = query.from_user.id
-    callback_data = query.data
-
-    logger.debug(f"Received callback query: {callback_data} from user {user_id}")
-
-    # Check if user is authenticated
-    if not db.is_user_authenticated(user_id):
-        await query.edit_message_text(
-            "⚠️ No estás autenticado. Por favor, usa /start e introduce la contraseña de acceso."
-        )
+async def _edit_reply_markup(query, markup: InlineKeyboardMarkup) -> None:
+    """Replaces the keyboard of the query's message, unless it already shows an equal one."""
+    # Telegram would reject the edit with "Message is not modified" anyway; comparing
+    # against the markup the callback arrived with saves the round-trip
+    if getattr(query.message, 'reply_markup', None) == markup:
         return
+    await query.edit_message_reply_markup(reply_markup=markup)
+
+# Each button handler receives the query, the context, the user id and the callback argument
+# (the part after the route prefix, empty for static buttons)
+async def _cb_main_menu(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, arg: str) -> None:
+    """Shows the main menu and resets the user state."""
+    await async_db.set_user_state(user_id, 'idle') # Ensure idle state
+    await query.edit_message_text(
+        text="Menú Principal:",
+        reply_markup=await _main_menu(context, user_id),
+        parse_mode=constants.ParseMode.HTML
+    )
 
-    # --- Main Menu Actions ---
-    if callback_data == 'main_menu':
-        db.set_user_state(user_id, 'idle') # Ensure idle state
+async def _cb_refresh_menu(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, arg: str) -> None:
+    """Rebuilds the main menu keyboard in place."""
+    await _edit_reply_markup(query, await _main_menu(context, user_id))
+
+async def _cb_set_base(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, arg: str) -> None:
+    """Starts base group selection."""
+    keyboard = get_group_selection_keyboard(context, CALLBACK_PREFIX_BASE, page=0)
+    if keyboard:
         await query.edit_message_text(
-            text="Menú Principal:",
-            reply_markup=get_main_menu_keyboard(user_id),
-            parse_mode=constants.ParseMode.HTML
+            text="Selecciona tu grupo base de la lista o reenvía un mensaje:",
+            reply_markup=keyboard
         )
-    elif callback_data == 'refresh_menu':
-         await query.edit_message_reply_markup(reply_markup=get_main_menu_keyboard(user_id))
+    else:
+         # Fallback if no known groups yet
+         await async_db.set_user_state(user_id, 'awaiting_base_forward')
+         await query.edit_message_text(
+             text="No conozco ningún grupo aún\. Por favor, **reenvíame un mensaje cualquiera** del grupo que quieres usar como **grupo base**\. Asegúrate de que estoy en ese grupo\.",
+             parse_mode=constants.ParseMode.HTML
+         )
 
-    # --- Base Group Selection Flow ---
-    elif callback_data == 'set_base':
-        keyboard = get_group_selection_keyboard(context, CALLBACK_PREFIX_BASE, page=0)
+async def _cb_select_page(action_prefix: str, query, context: ContextTypes.DEFAULT_TYPE, user_id: int, arg: str) -> None:
+    """Shows another page of the base/destination group selection keyboard."""
+    try:
+        page = int(arg)
+        keyboard = get_group_selection_keyboard(context, action_prefix, page=page)
         if keyboard:
-            await query.edit_message_text(
-                text="Selecciona tu grupo base de la lista o reenvía un mensaje:",
-                reply_markup=keyboard
-            )
-        else:
-             # Fallback if no known groups yet
-             db.set_user_state(user_id, 'awaiting_base_forward')
-             await query.edit_message_text(
-                 text="No conozco ningún grupo aún\. Por favor, **reenvíame un mensaje cualquiera** del grupo que quieres usar como **grupo base**\. Asegúrate de que estoy en ese grupo\.",
-                 parse_mode=constants.ParseMode.HTML
-             )
-
-    elif callback_data.startswith(f'{CALLBACK_PREFIX_BASE}_page_'):
-        try:
-            page = int(callback_data.split('_')[-1])
-            keyboard = get_group_selection_keyboard(context, CALLBACK_PREFIX_BASE, page=page)
-            if keyboard:
-                await query.edit_message_reply_markup(reply_markup=keyboard)
-        except (IndexError, ValueError):
-             logger.warning(f"Invalid pagination callback: {callback_data}")
-             await context.bot.send_message(chat_id=user_id, text="Error procesando la paginación.")
+            await _edit_reply_markup(query, keyboard)
+    except ValueError:
+         logger.warning(f"Invalid pagination callback: {query.data}")
+         await context.bot.send_message(chat_id=user_id, text="Error procesando la paginación.")
+
+async def _cb_base_forward_fallback(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, arg: str) -> None:
+    """Asks the user to forward a message from the base group."""
+    await async_db.set_user_state(user_id, 'awaiting_base_forward')
+    await query.edit_message_text(
+         text="Ok, por favor, <b>reenvíame un mensaje cualquiera</b> del grupo que quieres usar como <b>grupo base</b>. Asegúrate de que estoy en ese grupo.",
+         parse_mode=constants.ParseMode.HTML
+     )
+
+async def _cb_base_select(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, arg: str) -> None:
+    """Sets the base group picked from the selection keyboard."""
+    try:
+        picked = _resolve_chat_pick(context, arg)
+        if picked is None:
+            await _show_changed_selection(query, context, CALLBACK_PREFIX_BASE, user_id)
+            return
+        group_id, group_name = picked
+        logger.info(f"[User:{user_id} CB] Selected base group via button: chat_id={group_id}, name='{group_name}'")
 
-    elif callback_data == f'{CALLBACK_PREFIX_BASE}_forward_fallback':
-        db.set_user_state(user_id, 'awaiting_base_forward')
+        # Check bot membership (best effort) and read the destination count for the projected menu
+        bot_status, (_, dest_groups) = await asyncio.gather(
+            check_membership(context, group_id),
+            get_view_dest_keyboard(user_id)
+        )
+        # A membership warning goes on top of the confirmation, in the same edit
+        warning = ""
+        if bot_status is None or bot_status in _NOT_MEMBER_STATUSES:
+             logger.warning(f"[User:{user_id} CB] Couldn't confirm bot membership in {group_id} (status: {bot_status})")
+             warning = (f"⚠️ **¡Atención!** No he podido confirmar si estoy en el grupo '{group_name}'. "
+                        f"Asegúrate de que he sido añadido correctamente.\n\n"
+                        f"Continuaré con la configuración, pero podría fallar si no estoy en el grupo.\n\n")
+
+        invalidate_user_menus(user_id)
         await query.edit_message_text(
-             text="Ok, por favor, <b>reenvíame un mensaje cualquiera</b> del grupo que quieres usar como <b>grupo base</b>. Asegúrate de que estoy en ese grupo.",
+             f"{warning}✅ ¡Estupendo! Has establecido '{group_name}' como tu **grupo base**.\n\nMenú Principal:",
+             reply_markup=_remember_menu(context, _main_menu_markup((group_id, group_name), len(dest_groups))),
              parse_mode=constants.ParseMode.HTML
          )
+        # Rejected if another user already has this base group; it also resets the state to idle
+        await _persist_or_rollback(
+            context, query, user_id,
+            async_db.set_base_group(user_id, group_id, group_name),
+            "Error al establecer grupo base"
+        )
 
-    elif callback_data.startswith(f'{CALLBACK_PREFIX_BASE}_select_'):
-        try:
-            group_id = int(callback_data.split('_')[-1])
-            known_chats = context.bot_data.get('known_chats', {})
-            group_name = known_chats.get(group_id, f"Grupo desconocido ({group_id})")
-            logger.info(f"[User:{user_id} CB] Selected base group via button: chat_id={group_id}, name='{group_name}'")
-
-            # Check bot membership (best effort)
-            bot_status = "Unknown"
-            try:
-                 logger.debug(f"[User:{user_id} CB] Attempting get_chat_member for chat {group_id} (bot ID: {context.bot.id})")
-                 bot_member = await context.bot.get_chat_member(group_id, context.bot.id)
-                 bot_status = bot_member.status
-                 logger.info(f"[User:{user_id} CB] Bot membership status in {group_id}: {bot_status}")
-                 if bot_status in [constants.ChatMemberStatus.LEFT, constants.ChatMemberStatus.KICKED]:
-                     logger.warning(f"[User:{user_id} CB] Bot status is {bot_status} in chat {group_id}, raising exception for warning flow.")
-                     raise Exception(f"Bot status is {bot_status}")
-            except Exception as e:
-                 logger.error(f"[User:{user_id} CB] Error during get_chat_member for {group_id} or bot status check: {e!r}")
-                 await context.bot.send_message(
-                     chat_id=user_id,
-                     text=f"⚠️ **¡Atención!** No he podido confirmar si estoy en el grupo '{group_name}'. "
-                          f"Asegúrate de que he sido añadido correctamente.\n\n"
-                          f"Continuaré con la configuración, pero podría fallar si no estoy en el grupo.",
-                     parse_mode=constants.ParseMode.HTML
-                 )
-                 # Continue with configuration despite warning
-                 logger.info(f"[User:{user_id} CB] Proceeding with configuration for chat {group_id} despite membership check warning.")
-
-            # Set base group in DB
-            db.set_base_group(user_id, group_id, group_name)
-            db.set_user_state(user_id, 'idle')
-            await query.edit_message_text(
-                 f"✅ ¡Estupendo! Has establecido '{group_name}' como tu **grupo base**.\n\nMenú Principal:",
-                 reply_markup=get_main_menu_keyboard(user_id),
-                 parse_mode=constants.ParseMode.HTML
-             )
-
-        except (IndexError, ValueError):
-            logger.warning(f"Invalid group selection callback: {callback_data}")
-            await context.bot.send_message(chat_id=user_id, text="Error procesando la selección.")
-            await query.edit_message_text(text="Menú Principal:", reply_markup=get_main_menu_keyboard(user_id))
-            db.set_user_state(user_id, 'idle')
-        except ValueError as e: # Handles specific errors from db.set_base_group
-             await query.edit_message_text(f"⚠️ Error al establecer grupo base: {e}", reply_markup=get_main_menu_keyboard(user_id))
-             db.set_user_state(user_id, 'idle')
-        except Exception as e:
-            logger.error(f"Unexpected error setting base group via button for {user_id}: {e}", exc_info=True)
-            await query.edit_message_text("❌ Ocurrió un error inesperado.", reply_markup=get_main_menu_keyboard(user_id))
-            db.set_user_state(user_id, 'idle')
+    except ValueError:
+        logger.warning(f"Invalid group selection callback: {query.data}")
+        await query.edit_message_text(text="Error procesando la selección.\n\nMenú Principal:", reply_markup=await _fallback_menu(context, user_id))
+        await async_db.set_user_state(user_id, 'idle')
+    except Exception as e:
+        logger.error(f"Unexpected error setting base group via button for {user_id}: {e}", exc_info=True)
+        await query.edit_message_text("❌ Ocurrió un error inesperado.", reply_markup=await _fallback_menu(context, user_id))
+        await async_db.set_user_state(user_id, 'idle')
+
+async def _cb_clear_base(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, arg: str) -> None:
+    """Removes the user's base group."""
+    invalidate_user_menus(user_id)
+    await query.edit_message_text(
+        text="✅ Grupo base eliminado. Ya no se reenviarán mensajes desde ese grupo.\n\nMenú Principal:",
+        reply_markup=_remember_menu(context, _main_menu_markup(None, 0)),
+        parse_mode=constants.ParseMode.HTML
+    )
+    await _persist_or_rollback(context, query, user_id, async_db.clear_base_group(user_id), "Error al eliminar el grupo base")
+
+async def _cb_add_dest(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, arg: str) -> None:
+    """Starts destination group selection."""
+    base_group = await async_db.get_base_group(user_id)
+    if not base_group:
+         await query.edit_message_text(
+            text="⚠️ Primero debes establecer un grupo base antes de añadir destinos.\n\nMenú Principal:",
+            reply_markup=await _main_menu(context, user_id),
+            parse_mode=constants.ParseMode.HTML
+         )
+         return
 
-    # --- Clear Base Group ---
-    elif callback_data == 'clear_base':
-        db.clear_base_group(user_id)
+    keyboard = get_group_selection_keyboard(context, CALLBACK_PREFIX_DEST, page=0)
+    if keyboard:
+        await query.edit_message_text(
+            text="Selecciona un grupo destino de la lista o reenvía un mensaje:",
+            reply_markup=keyboard
+        )
+    else:
+        # Fallback if no known groups yet
+        await async_db.set_user_state(user_id, 'awaiting_dest_forward')
         await query.edit_message_text(
-            text="✅ Grupo base eliminado. Ya no se reenviarán mensajes desde ese grupo.\n\nMenú Principal:",
-            reply_markup=get_main_menu_keyboard(user_id),
+            text="No conozco ningún grupo aún\. Por favor, **reenvíame un mensaje cualquiera** del grupo que quieres añadir como **destino**\. Asegúrate de que estoy en ese grupo\.",
             parse_mode=constants.ParseMode.HTML
         )
 
-    # --- Destination Group Selection Flow (Mirrors Base Group Flow) ---
-    elif callback_data == 'add_dest':
-        base_group = db.get_base_group(user_id)
-        if not base_group:
-             await query.edit_message_text(
-                text="⚠️ Primero debes establecer un grupo base antes de añadir destinos.\n\nMenú Principal:",
-                reply_markup=get_main_menu_keyboard(user_id),
-                parse_mode=constants.ParseMode.HTML
-             )
-             return
+async def _cb_dest_forward_fallback(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, arg: str) -> None:
+    """Asks the user to forward a message from the destination group."""
+    await async_db.set_user_state(user_id, 'awaiting_dest_forward')
+    await query.edit_message_text(
+         text="Ok, por favor, <b>reenvíame un mensaje cualquiera</b> del grupo que quieres añadir como <b>destino</b>. Asegúrate de que estoy en ese grupo.",
+         parse_mode=constants.ParseMode.HTML
+     )
+
+async def _cb_dest_select(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, arg: str) -> None:
+    """Adds the destination group picked from the selection keyboard."""
+    base_group = await async_db.get_base_group(user_id)
+    if not base_group:
+         await query.edit_message_text("⚠️ Error interno: No hay grupo base configurado. Por favor, vuelve al menú principal.", reply_markup=await _main_menu(context, user_id))
+         await async_db.set_user_state(user_id, 'idle')
+         return
+    base_group_id, base_group_name = base_group
 
-        keyboard = get_group_selection_keyboard(context, CALLBACK_PREFIX_DEST, page=0)
-        if keyboard:
+    try:
+        picked = _resolve_chat_pick(context, arg)
+        if picked is None:
+            await _show_changed_selection(query, context, CALLBACK_PREFIX_DEST, user_id)
+            return
+        group_id, group_name = picked
+        logger.info(f"[User:{user_id} CB] Selected dest group via button: chat_id={group_id}, name='{group_name}'")
+
+        # --- Conflict Checks ---
+        # Check base == destination conflict (no I/O, so before anything else)
+        if group_id == base_group_id:
+            # Show selection again or main menu?
+            keyboard = get_group_selection_keyboard(context, CALLBACK_PREFIX_DEST, page=0)
             await query.edit_message_text(
-                text="Selecciona un grupo destino de la lista o reenvía un mensaje:",
-                reply_markup=keyboard
+                text=f"⚠️ No puedes añadir el grupo base ('{base_group_name}') como grupo destino.\n\nSelecciona un grupo destino diferente:",
+                reply_markup=keyboard or await _main_menu(context, user_id)
             )
-        else:
-            # Fallback if no known groups yet
-            db.set_user_state(user_id, 'awaiting_dest_forward')
+            return # Keep state, let user choose again
+
+        # Bot membership (network, best effort), the cross-user conflict check and the current
+        # destination list (DB) are independent, so wait for them together
+        bot_status, conflict, (_, dest_groups) = await asyncio.gather(
+            check_membership(context, group_id),
+            async_db.check_destination_conflict(base_group_id, group_id),
+            get_view_dest_keyboard(user_id)
+        )
+
+        # Already one of this user's destinations: reject it here rather than confirm and roll back
+        if any(rule[0] == group_id for rule in dest_groups):
+            keyboard = get_group_selection_keyboard(context, CALLBACK_PREFIX_DEST, page=0)
             await query.edit_message_text(
-                text="No conozco ningún grupo aún\. Por favor, **reenvíame un mensaje cualquiera** del grupo que quieres añadir como **destino**\. Asegúrate de que estoy en ese grupo\.",
-                parse_mode=constants.ParseMode.HTML
+                text=f"⚠️ Ya tienes añadido el grupo '{group_name}' (ID: {group_id}) como destino.\n\nSelecciona un grupo destino diferente:",
+                reply_markup=keyboard or await _main_menu(context, user_id)
             )
+            return # Keep state, let user choose again
 
-    elif callback_data.startswith(f'{CALLBACK_PREFIX_DEST}_page_'):
-        try:
-            page = int(callback_data.split('_')[-1])
-            keyboard = get_group_selection_keyboard(context, CALLBACK_PREFIX_DEST, page=page)
-            if keyboard:
-                await query.edit_message_reply_markup(reply_markup=keyboard)
-        except (IndexError, ValueError):
-             logger.warning(f"Invalid pagination callback: {callback_data}")
-             await context.bot.send_message(chat_id=user_id, text="Error procesando la paginación.")
-
-    elif callback_data == f'{CALLBACK_PREFIX_DEST}_forward_fallback':
-        db.set_user_state(user_id, 'awaiting_dest_forward')
+        # Check existing base->dest conflict across all users
+        if conflict:
+            keyboard = get_group_selection_keyboard(context, CALLBACK_PREFIX_DEST, page=0)
+            await query.edit_message_text(
+                text=f"⚠️ ¡Conflicto! Otro usuario ya está reenviando desde '{base_group_name}' hacia '{group_name}'.\n\nSelecciona un grupo destino diferente:",
+                reply_markup=keyboard or await _main_menu(context, user_id)
+            )
+            return # Keep state, let user choose again
+
+        # Allow adding anyway, but warn the user on top of the confirmation
+        warning = ""
+        if bot_status is None or bot_status in _NOT_MEMBER_STATUSES:
+             logger.warning(f"[User:{user_id} CB] Couldn't confirm bot membership in {group_id} (status: {bot_status})")
+             warning = f"⚠️ **¡Atención!** No pude confirmar si estoy en el grupo '{group_name}'. Asegúrate de que me han añadido.\n\n"
+
+        # --- Add Destination Group ---
+        logger.info(f"[User:{user_id} CB] Attempting to add destination group: chat_id={group_id}, name='{group_name}'")
+        invalidate_user_menus(user_id)
+        dest_count = len(dest_groups) + 1
         await query.edit_message_text(
-             text="Ok, por favor, <b>reenvíame un mensaje cualquiera</b> del grupo que quieres añadir como <b>destino</b>. Asegúrate de que estoy en ese grupo.",
+             f"{warning}✅ ¡Grupo destino '{group_name}' añadido! Tienes {dest_count} total.\n\nMenú Principal:",
+             reply_markup=_remember_menu(context, _main_menu_markup(base_group, dest_count)),
              parse_mode=constants.ParseMode.HTML
          )
+        # Also resets the state to idle
+        await _persist_or_rollback(
+            context, query, user_id,
+            async_db.add_destination_group(user_id, group_id, group_name),
+            "Error al añadir grupo destino"
+        )
 
-    elif callback_data.startswith(f'{CALLBACK_PREFIX_DEST}_select_'):
-        base_group = db.get_base_group(user_id)
-        if not base_group:
-             await query.edit_message_text("⚠️ Error interno: No hay grupo base configurado. Por favor, vuelve al menú principal.", reply_markup=get_main_menu_keyboard(user_id))
-             db.set_user_state(user_id, 'idle')
-             return
-        base_group_id, base_group_name = base_group
-
-        try:
-            group_id = int(callback_data.split('_')[-1])
-            known_chats = context.bot_data.get('known_chats', {})
-            group_name = known_chats.get(group_id, f"Grupo desconocido ({group_id})")
-            logger.info(f"[User:{user_id} CB] Selected dest group via button: chat_id={group_id}, name='{group_name}'")
+    except ValueError:
+        logger.warning(f"Invalid group selection callback: {query.data}")
+        await query.edit_message_text(text="Error procesando la selección.\n\nMenú Principal:", reply_markup=await _fallback_menu(context, user_id))
+        await async_db.set_user_state(user_id, 'idle')
+    except Exception as e:
+        logger.error(f"Unexpected error setting dest group via button for {user_id}: {e}", exc_info=True)
+        await query.edit_message_text("❌ Ocurrió un error inesperado.", reply_markup=await _fallback_menu(context, user_id))
+        await async_db.set_user_state(user_id, 'idle')
+
+async def _cb_view_dest(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, arg: str) -> None:
+    """Lists the destination groups with delete/mode buttons."""
+    keyboard, dest_groups = await get_view_dest_keyboard(user_id)
+    if keyboard:
+         await query.edit_message_text(
+             text=f"Tus grupos destino ({len(dest_groups)}):\n(Pulsa ❌ para eliminar un grupo, o su modo para alternar entre reenviar y copiar sin la cabecera \"Reenviado de\")",
+             reply_markup=keyboard,
+             parse_mode=constants.ParseMode.HTML
+         )
+    else:
+        await query.edit_message_text(
+            text="No tienes grupos destino configurados.\n\nMenú Principal:",
+            reply_markup=await _main_menu(context, user_id),
+            parse_mode=constants.ParseMode.HTML
+        )
 
-            # Check bot membership (best effort)
-            bot_status = "Unknown"
-            try:
-                 logger.debug(f"[User:{user_id} CB] Attempting get_chat_member for chat {group_id} (bot ID: {context.bot.id})")
-                 bot_member = await context.bot.get_chat_member(group_id, context.bot.id)
-                 bot_status = bot_member.status
-                 logger.info(f"[User:{user_id} CB] Bot membership status in {group_id}: {bot_status}")
-                 if bot_status in [constants.ChatMemberStatus.LEFT, constants.ChatMemberStatus.KICKED]:
-                     logger.warning(f"[User:{user_id} CB] Bot status is {bot_status} in chat {group_id}, raising exception for warning flow.")
-                     raise Exception(f"Bot status is {bot_status}")
-            except Exception as e:
-                 logger.error(f"[User:{user_id} CB] Error during get_chat_member for {group_id} or bot status check: {e!r}")
-                 await context.bot.send_message(
-                     chat_id=user_id,
-                     text=f"⚠️ **¡Atención!** No pude confirmar si estoy en el grupo '{group_name}'. Asegúrate de que me han añadido.",
+async def _cb_delete_dest(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, arg: str) -> None:
+    """Deletes a destination group and refreshes the list."""
+    try:
+        group_id_to_delete = int(arg)
+        _, dest_groups = await get_view_dest_keyboard(user_id)
+        remaining = [rule for rule in dest_groups if rule[0] != group_id_to_delete]
+        if len(remaining) < len(dest_groups):
+            invalidate_user_menus(user_id)
+            notice = f"✅ Grupo destino (ID: {group_id_to_delete}) eliminado.\n\n"
+             # Refresh the delete view or go back to main menu
+            keyboard = _dest_view_markup(remaining)
+            if keyboard:
+                await query.edit_message_text(
+                    text=f"{notice}Tus grupos destino ({len(remaining)}):\n(Pulsa ❌ para eliminar un grupo, o su modo para alternar entre reenviar y copiar sin la cabecera \"Reenviado de\")",
+                    reply_markup=keyboard,
+                    parse_mode=constants.ParseMode.HTML
+                )
+            else:
+                 await query.edit_message_text(
+                     text=f"{notice}Todos los grupos destino eliminados.\n\nMenú Principal:",
+                     reply_markup=_remember_menu(context, _main_menu_markup(await async_db.get_base_group(user_id), 0)),
                      parse_mode=constants.ParseMode.HTML
                  )
-                 # Allow adding anyway, but warn the user
-
-            # --- Conflict Checks ---
-            # Check base == destination conflict
-            if group_id == base_group_id:
-                await context.bot.send_message(chat_id=user_id, text=f"⚠️ No puedes añadir el grupo base ('{base_group_name}') como grupo destino.")
-                # Show selection again or main menu?
-                keyboard = get_group_selection_keyboard(context, CALLBACK_PREFIX_DEST, page=0)
-                await query.edit_message_text(text="Selecciona un grupo destino diferente:", reply_markup=keyboard or get_main_menu_keyboard(user_id))
-                return # Keep state, let user choose again
-
-            # Check existing base->dest conflict across all users
-            if db.check_destination_conflict(base_group_id, group_id):
-                await context.bot.send_message(chat_id=user_id, text=f"⚠️ ¡Conflicto! Otro usuario ya está reenviando desde '{base_group_name}' hacia '{group_name}'.")
-                keyboard = get_group_selection_keyboard(context, CALLBACK_PREFIX_DEST, page=0)
-                await query.edit_message_text(text="Selecciona un grupo destino diferente:", reply_markup=keyboard or get_main_menu_keyboard(user_id))
-                return # Keep state, let user choose again
-
-            # --- Add Destination Group ---
-            logger.info(f"[User:{user_id} CB] Attempting to add destination group: chat_id={group_id}, name='{group_name}'")
-            db.add_destination_group(user_id, group_id, group_name)
-            logger.info(f"[User:{user_id} CB] Successfully added destination group {group_id}.")
-            db.set_user_state(user_id, 'idle')
-            dest_count = len(db.get_destination_groups(user_id))
-            await query.edit_message_text(
-                 f"✅ ¡Grupo destino '{group_name}' añadido! Tienes {dest_count} total.\n\nMenú Principal:",
-                 reply_markup=get_main_menu_keyboard(user_id),
-                 parse_mode=constants.ParseMode.HTML
-             )
-
-        except (IndexError, ValueError) as e:
-            logger.warning(f"Invalid group selection callback: {callback_data} or DB issue: {e}")
-            await context.bot.send_message(chat_id=user_id, text="Error procesando la selección.")
-            await query.edit_message_text(text="Menú Principal:", reply_markup=get_main_menu_keyboard(user_id))
-            db.set_user_state(user_id, 'idle')
-        except ValueError as e: # Handles specific errors from db.add_destination_group (like duplicate)
-             await query.edit_message_text(f"⚠️ Error al añadir grupo destino: {e}", reply_markup=get_main_menu_keyboard(user_id))
-             db.set_user_state(user_id, 'idle')
-        except Exception as e:
-            logger.error(f"Unexpected error setting dest group via button for {user_id}: {e}", exc_info=True)
-            await query.edit_message_text("❌ Ocurrió un error inesperado.", reply_markup=get_main_menu_keyboard(user_id))
-            db.set_user_state(user_id, 'idle')
-
-    # --- View/Delete Destination Groups ---
-    elif callback_data == 'view_dest':
-        keyboard = get_view_dest_keyboard(user_id)
-        dest_groups = db.get_destination_groups(user_id) # Fetch again for count
-        if keyboard:
+            await _persist_or_rollback(
+                context, query, user_id,
+                async_db.remove_destination_group(user_id, group_id_to_delete),
+                "Error al eliminar el grupo destino"
+            )
+        else:
+             # Refresh view just in case (from the DB, the cached list is what was out of date)
+             invalidate_user_menus(user_id)
+             keyboard, dest_groups = await get_view_dest_keyboard(user_id)
              await query.edit_message_text(
-                 text=f"Tus grupos destino ({len(dest_groups)}):\n(Pulsa sobre un grupo para eliminarlo)",
+                 text=f"⚠️ No se pudo eliminar el grupo destino (ID: {group_id_to_delete}), quizás ya no existía.\n\n"
+                      f"Tus grupos destino ({len(dest_groups)}):\n(Pulsa ❌ para eliminar un grupo, o su modo para alternar entre reenviar y copiar sin la cabecera \"Reenviado de\")",
                  reply_markup=keyboard,
                  parse_mode=constants.ParseMode.HTML
              )
-        else:
-            await query.edit_message_text(
-                text="No tienes grupos destino configurados.\n\nMenú Principal:",
-                reply_markup=get_main_menu_keyboard(user_id),
-                parse_mode=constants.ParseMode.HTML
-            )
 
-    elif callback_data.startswith('delete_dest_'):
-        try:
-            group_id_to_delete = int(callback_data.split('_')[2])
-            removed = db.remove_destination_group(user_id, group_id_to_delete)
-            if removed:
-                await context.bot.send_message(chat_id=user_id, text=f"✅ Grupo destino (ID: {group_id_to_delete}) eliminado.")
-                 # Refresh the delete view or go back to main menu
-                keyboard = get_view_dest_keyboard(user_id)
-                dest_groups = db.get_destination_groups(user_id) # Fetch again for count
-                if keyboard:
-                    await query.edit_message_text(
-                        text=f"Tus grupos destino ({len(dest_groups)}):\n(Pulsa sobre un grupo para eliminarlo)",
-                        reply_markup=keyboard,
-                        parse_mode=constants.ParseMode.HTML
-                    )
-                else:
-                     await query.edit_message_text(
-                         text="Todos los grupos destino eliminados.\n\nMenú Principal:",
-                         reply_markup=get_main_menu_keyboard(user_id),
-                         parse_mode=constants.ParseMode.HTML
-                     )
-            else:
-                 await context.bot.send_message(chat_id=user_id, text=f"⚠️ No se pudo eliminar el grupo destino (ID: {group_id_to_delete}), quizás ya no existía.")
-                 # Refresh view just in case
-                 keyboard = get_view_dest_keyboard(user_id)
-                 dest_groups = db.get_destination_groups(user_id) # Fetch again for count
-                 await query.edit_message_text(
-                     text=f"Tus grupos destino ({len(dest_groups)}):\n(Pulsa sobre un grupo para eliminarlo)",
-                     reply_markup=keyboard,
-                     parse_mode=constants.ParseMode.HTML
-                 )
+    except (IndexError, ValueError):
+        logger.warning(f"Invalid callback data for delete_dest: {query.data}")
+        # Go back to main menu on error
+        await query.edit_message_text(
+            text="Error procesando la solicitud.\n\nMenú Principal:",
+            reply_markup=await _fallback_menu(context, user_id),
+            parse_mode=constants.ParseMode.HTML
+        )
 
-        except (IndexError, ValueError):
-            logger.warning(f"Invalid callback data for delete_dest: {callback_data}")
-            await context.bot.send_message(chat_id=user_id, text="Error procesando la solicitud.")
-            # Go back to main menu on error
-            await query.edit_message_text(
-                text="Menú Principal:",
-                reply_markup=get_main_menu_keyboard(user_id),
-                parse_mode=constants.ParseMode.HTML
-            )
+async def _cb_toggle_copy(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, arg: str) -> None:
+    """Switches a destination between forwarding and copying."""
+    try:
+        group_id = int(arg)
+        if await async_db.toggle_destination_copy_mode(user_id, group_id) is not None:
+            invalidate_forwarding_cache(context)
+            invalidate_user_menus(user_id)
+        keyboard, _ = await get_view_dest_keyboard(user_id)
+        if keyboard:
+            await _edit_reply_markup(query, keyboard)
+    except (IndexError, ValueError):
+        logger.warning(f"Invalid callback data for toggle_copy: {query.data}")
+        await context.bot.send_message(chat_id=user_id, text="Error procesando la solicitud.")
 
-    # --- View Configuration ---
-    elif callback_data == 'view_config':
-        base_group = db.get_base_group(user_id)
-        dest_groups = db.get_destination_groups(user_id)
+async def _cb_reactivate_dest(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, arg: str) -> None:
+    """Re-enables a destination that was deactivated after delivery failures."""
+    try:
+        group_id = int(arg)
+        if await async_db.reactivate_destination_group(user_id, group_id):
+            invalidate_forwarding_cache(context)
+            invalidate_user_menus(user_id)
+        keyboard, _ = await get_view_dest_keyboard(user_id)
+        if keyboard:
+            await _edit_reply_markup(query, keyboard)
+    except (IndexError, ValueError):
+        logger.warning(f"Invalid callback data for reactivate_dest: {query.data}")
+        await context.bot.send_message(chat_id=user_id, text="Error procesando la solicitud.")
+
+async def _cb_view_config(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, arg: str) -> None:
+    """Shows the user's current configuration."""
+    base_group, dest_groups = await asyncio.gather(
+        async_db.get_base_group(user_id),
+        async_db.get_destination_rules(user_id)
+    )
 
-        message = "<b>⚙️ Tu Configuración Actual ⚙️</b>\n\n"
-        if base_group:
-            base_id, base_name = base_group
-            message += f"<b>*️⃣ Grupo Base:</b> {base_name} (ID: <code>{base_id}</code>)\n"
-        else:
-            message += "<b>*️⃣ Grupo Base:</b> ¡No establecido!\n"
+    message = "<b>⚙️ Tu Configuración Actual ⚙️</b>\n\n"
+    if base_group:
+        base_id, base_name = base_group
+        message += f"<b>*️⃣ Grupo Base:</b> {base_name} (ID: <code>{base_id}</code>)\n"
+    else:
+        message += "<b>*️⃣ Grupo Base:</b> ¡No establecido!\n"
 
-        message += f"\n<b>➡️ Grupos Destino ({len(dest_groups)}):</b>\n"
-        if dest_groups:
-            for i, (dest_id, dest_name) in enumerate(dest_groups):
-                message += f"  {i+1}. {dest_name} (ID: <code>{dest_id}</code>)\n"
-        else:
-            message += "  ¡Ninguno! No se reenviarán mensajes.\n"
+    message += f"\n<b>➡️ Grupos Destino ({len(dest_groups)}):</b>\n"
+    if dest_groups:
+        for i, (dest_id, dest_name, _, is_active) in enumerate(dest_groups):
+            status = "" if is_active else " ⏸️ <i>inactivo</i>"
+            message += f"  {i+1}. {dest_name} (ID: <code>{dest_id}</code>){status}\n"
+    else:
+        message += "  ¡Ninguno! No se reenviarán mensajes.\n"
+
+    await query.edit_message_text(
+        text=message,
+        reply_markup=await _main_menu(context, user_id), # Show main menu again
+        parse_mode=constants.ParseMode.HTML
+    )
+
+# Static buttons match their callback data exactly; parametrised ones are '<route>_<arg>'
+CALLBACK_ROUTES = {
+    'main_menu': _cb_main_menu,
+    'refresh_menu': _cb_refresh_menu,
+    'set_base': _cb_set_base,
+    f'{CALLBACK_PREFIX_BASE}_page': functools.partial(_cb_select_page, CALLBACK_PREFIX_BASE),
+    f'{CALLBACK_PREFIX_BASE}_forward_fallback': _cb_base_forward_fallback,
+    f'{CALLBACK_PREFIX_BASE}_select': _cb_base_select,
+    'clear_base': _cb_clear_base,
+    'add_dest': _cb_add_dest,
+    f'{CALLBACK_PREFIX_DEST}_page': functools.partial(_cb_select_page, CALLBACK_PREFIX_DEST),
+    f'{CALLBACK_PREFIX_DEST}_forward_fallback': _cb_dest_forward_fallback,
+    f'{CALLBACK_PREFIX_DEST}_select': _cb_dest_select,
+    'view_dest': _cb_view_dest,
+    'delete_dest': _cb_delete_dest,
+    'toggle_copy': _cb_toggle_copy,
+    'reactivate_dest': _cb_reactivate_dest,
+    'view_config': _cb_view_config,
+}
 
+async def button_callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handles all button presses from inline keyboards."""
+    query = update.callback_query
+    await query.answer() # Acknowledge the button press
+    user_id = query.from_user.id
+    callback_data = query.data
+
+    logger.debug(f"Received callback query: {callback_data} from user {user_id}")
+
+    # Check if user is authenticated
+    if not await is_authenticated(context, user_id):
         await query.edit_message_text(
-            text=message,
-            reply_markup=get_main_menu_keyboard(user_id), # Show main menu again
-            parse_mode=constants.ParseMode.HTML
+            "⚠️ No estás autenticado. Por favor, usa /start e introduce la contraseña de acceso."
         )
+        return
 
-    else:
+    # One lookup for static buttons, a second one on the prefix for parametrised ones
+    arg = ''
+    handler = CALLBACK_ROUTES.get(callback_data)
+    if handler is None:
+        route, _, arg = callback_data.rpartition('_')
+        handler = CALLBACK_ROUTES.get(route)
+    if handler is None:
         logger.warning(f"Unhandled callback query data: {callback_data}")
         # Optionally send a message if an unknown button is pressed
         # await context.bot.send_message(chat_id=user_id, text="Comando desconocido.")
+        return
+
+    await handler(query, context, user_id, arg)
 
 # --- Message Handlers ---
 async def handle_forwarded_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -511,7 +965,7 @@ async def handle_forwarded_message(update: Update, context: ContextTypes.DEFAULT
     user_id = user.id
 
     # Check if user is authenticated
-    if not db.is_user_authenticated(user_id):
+    if not await is_authenticated(context, user_id):
         await message.reply_text(
             "⚠️ No estás autenticado. Por favor, usa /start e introduce la contraseña de acceso."
         )
@@ -538,44 +992,33 @@ async def handle_forwarded_message(update: Update, context: ContextTypes.DEFAULT
     if not forwarded_chat:
         await message.reply_text(
             "No puedo identificar el grupo de origen de este mensaje reenviado. Intenta reenviar un mensaje diferente.",
-            reply_markup=get_main_menu_keyboard(user_id)
+            reply_markup=await _main_menu(context, user_id)
         )
-        db.set_user_state(user_id, 'idle')
+        await async_db.set_user_state(user_id, 'idle')
         return
         
     # Continue with the existing logic using forwarded_chat
-    if not forwarded_chat or forwarded_chat.type not in [constants.ChatType.GROUP, constants.ChatType.SUPERGROUP, constants.ChatType.CHANNEL]:
+    if not forwarded_chat or forwarded_chat.type not in _GROUPISH_CHAT_TYPES:
         await message.reply_text(
             "Por favor, reenvía un mensaje desde un **grupo** o **canal**.",
-             reply_markup=get_main_menu_keyboard(user_id)
+             reply_markup=await _main_menu(context, user_id)
         )
-        db.set_user_state(user_id, 'idle')
+        await async_db.set_user_state(user_id, 'idle')
         return
 
     group_id = forwarded_chat.id
     group_name = forwarded_chat.title or f"Grupo/Canal sin nombre (ID: {group_id})"
-    current_state = db.get_user_state(user_id)
+    current_state = await async_db.get_user_state(user_id)
 
     # Add the successfully identified chat to known chats
-    add_known_chat(context, group_id, group_name)
+    add_known_chat(context, group_id, group_name, forwarded_chat.type)
 
     logger.info(f"Received forwarded message from chat {group_id} ({group_name}) for user {user_id} in state {current_state}")
 
     # Check bot membership (best effort)
-    bot_status = "Unknown"
-    try:
-        logger.debug(f"[User:{user_id}] Attempting get_chat_member for chat {group_id} (bot ID: {context.bot.id})")
-        bot_member = await context.bot.get_chat_member(group_id, context.bot.id)
-        bot_status = bot_member.status
-        logger.info(f"[User:{user_id}] Bot membership status in {group_id}: {bot_status}")
-        if bot_status in [constants.ChatMemberStatus.LEFT, constants.ChatMemberStatus.KICKED]:
-            # Log specific KICKED/LEFT status before raising general exception
-            logger.warning(f"[User:{user_id}] Bot status is {bot_status} in chat {group_id}, raising exception for warning flow.")
-            raise Exception(f"Bot status is {bot_status}") # Raise to trigger the warning message flow
-
-    except Exception as e:
-        # Log the specific error received from get_chat_member or the self-raised exception
-        logger.error(f"[User:{user_id}] Error during get_chat_member for {group_id} or bot status check: {e!r}") # Log repr(e)
+    bot_status = await check_membership(context, group_id)
+    if bot_status is None or bot_status in _NOT_MEMBER_STATUSES:
+        logger.warning(f"[User:{user_id}] Couldn't confirm bot membership in {group_id} (status: {bot_status})")
         await message.reply_text(
              f"⚠️ **¡Atención!** No he podido confirmar si estoy en el grupo '{group_name}'. "
              f"Asegúrate de que he sido añadido correctamente.\n\n"
@@ -588,28 +1031,30 @@ async def handle_forwarded_message(update: Update, context: ContextTypes.DEFAULT
     if current_state == 'awaiting_base_forward':
         try:
             logger.info(f"[User:{user_id}] Attempting to set base group: chat_id={group_id}, name='{group_name}'")
-            db.set_base_group(user_id, group_id, group_name)
+            await async_db.set_base_group(user_id, group_id, group_name)
+            invalidate_forwarding_cache(context)
+            invalidate_user_menus(user_id)
             logger.info(f"[User:{user_id}] Successfully set base group {group_id}.")
             await message.reply_text(
                 f"✅ ¡Estupendo! Has establecido '{group_name}' como tu <b>grupo base</b>.\n\n"
                 f"Ahora puedes añadir grupos destino desde el menú.",
-                reply_markup=get_main_menu_keyboard(user_id),
+                reply_markup=await _main_menu(context, user_id),
                 parse_mode=constants.ParseMode.HTML
             )
         except ValueError as e: # Handles specific errors from db layer
-             await message.reply_text(f"⚠️ Error al establecer grupo base: {e}", reply_markup=get_main_menu_keyboard(user_id))
+             await message.reply_text(f"⚠️ Error al establecer grupo base: {e}", reply_markup=await _fallback_menu(context, user_id))
         except Exception as e:
             logger.error(f"Unexpected error setting base group for {user_id}: {e}")
-            await message.reply_text("❌ Ocurrió un error inesperado al guardar el grupo base.", reply_markup=get_main_menu_keyboard(user_id))
+            await message.reply_text("❌ Ocurrió un error inesperado al guardar el grupo base.", reply_markup=await _fallback_menu(context, user_id))
         finally:
-             db.set_user_state(user_id, 'idle') # Always reset state
+             await async_db.set_user_state(user_id, 'idle') # Always reset state
 
 
     elif current_state == 'awaiting_dest_forward':
-        base_group = db.get_base_group(user_id)
+        base_group = await async_db.get_base_group(user_id)
         if not base_group: # Should not happen if state is correct, but check anyway
-             await message.reply_text("⚠️ Error interno: No hay grupo base configurado. Por favor, vuelve a empezar.", reply_markup=get_main_menu_keyboard(user_id))
-             db.set_user_state(user_id, 'idle')
+             await message.reply_text("⚠️ Error interno: No hay grupo base configurado. Por favor, vuelve a empezar.", reply_markup=await _main_menu(context, user_id))
+             await async_db.set_user_state(user_id, 'idle')
              return
 
         base_group_id, _ = base_group
@@ -618,45 +1063,47 @@ async def handle_forwarded_message(update: Update, context: ContextTypes.DEFAULT
         if group_id == base_group_id:
             await message.reply_text(
                  f"⚠️ No puedes añadir el grupo base ('{group_name}') como grupo destino.",
-                reply_markup=get_main_menu_keyboard(user_id)
+                reply_markup=await _main_menu(context, user_id)
             )
-            db.set_user_state(user_id, 'idle')
+            await async_db.set_user_state(user_id, 'idle')
             return
 
         # Check for conflict: ANY user forwarding from this user's base_group_id TO the new group_id
-        if db.check_destination_conflict(base_group_id, group_id):
+        if await async_db.check_destination_conflict(base_group_id, group_id):
             await message.reply_text(
                 f"⚠️ ¡Conflicto! Otro usuario ya está reenviando mensajes desde tu grupo base ('{base_group[1]}') hacia este grupo destino ('{group_name}'). No se permite esta configuración duplicada.",
-                reply_markup=get_main_menu_keyboard(user_id)
+                reply_markup=await _main_menu(context, user_id)
             )
-            db.set_user_state(user_id, 'idle')
+            await async_db.set_user_state(user_id, 'idle')
             return
 
         try:
             logger.info(f"[User:{user_id}] Attempting to add destination group: chat_id={group_id}, name='{group_name}'")
-            db.add_destination_group(user_id, group_id, group_name)
+            await async_db.add_destination_group(user_id, group_id, group_name)
+            invalidate_forwarding_cache(context)
+            invalidate_user_menus(user_id)
             logger.info(f"[User:{user_id}] Successfully added destination group {group_id}.")
-            dest_count = len(db.get_destination_groups(user_id))
+            dest_count = len((await get_view_dest_keyboard(user_id))[1]) # Also warms the cache for 'view_dest'
             await message.reply_text(
                 f"✅ ¡Grupo destino '{group_name}' añadido! "
                 f"Ahora tienes {dest_count} {'grupo destino' if dest_count == 1 else 'grupos destino'}.\n\n"
                 f"Puedes añadir más o volver al menú.",
-                reply_markup=get_main_menu_keyboard(user_id), # Back to main menu
+                reply_markup=await _main_menu(context, user_id), # Back to main menu
                 parse_mode=constants.ParseMode.HTML
             )
         except ValueError as e: # Handles specific errors from db layer (e.g., duplicate)
-            await message.reply_text(f"⚠️ Error al añadir grupo destino: {e}", reply_markup=get_main_menu_keyboard(user_id))
+            await message.reply_text(f"⚠️ Error al añadir grupo destino: {e}", reply_markup=await _fallback_menu(context, user_id))
         except Exception as e:
             logger.error(f"Unexpected error adding destination group for {user_id}: {e}")
-            await message.reply_text("❌ Ocurrió un error inesperado al guardar el grupo destino.", reply_markup=get_main_menu_keyboard(user_id))
+            await message.reply_text("❌ Ocurrió un error inesperado al guardar el grupo destino.", reply_markup=await _fallback_menu(context, user_id))
         finally:
-             db.set_user_state(user_id, 'idle') # Always reset state
+             await async_db.set_user_state(user_id, 'idle') # Always reset state
 
     else:
         # Received a forwarded message but wasn't expecting one
         await message.reply_text(
             "Recibí un mensaje reenviado, pero no estaba esperando uno ahora mismo. Si querías configurar un grupo, usa los botones del menú primero.",
-            reply_markup=get_main_menu_keyboard(user_id)
+            reply_markup=await _main_menu(context, user_id)
         )
 
 
@@ -668,76 +1115,62 @@ async def handle_group_message(update: Update, context: ContextTypes.DEFAULT_TYP
     if not message or not chat:
         return # Ignore updates without message/chat
 
+    current_chat_id = chat.id # Read once, used on every step below
+
     # Store chat info if it's a group/channel/supergroup BEFORE any other processing
-    if chat.type in [constants.ChatType.GROUP, constants.ChatType.SUPERGROUP, constants.ChatType.CHANNEL]:
-        add_known_chat(context, chat.id, chat.title or f"Chat sin nombre ({chat.id})") # Use helper
+    if chat.type in _GROUPISH_CHAT_TYPES:
+        add_known_chat(context, current_chat_id, chat.title or f"Chat sin nombre ({current_chat_id})", chat.type) # Use helper
 
-    # Get all forwarding configurations
-    forwarding_config = db.get_all_forwarding_configs()
-    
-    # Check if this chat is registered as a base group for message forwarding
-    if chat.id not in forwarding_config:
+    # Get all forwarding configurations (cached, only rules of authenticated users)
+    forwarding_config = await _get_configs_cached(context)
+
+    # Most chats are not base groups, bail out before touching the full config
+    if current_chat_id not in context.application.bot_data.get('_fwd_base_ids', frozenset()):
         return # This group isn't configured as a base group, ignore message
-        
+
     # Get list of destination groups for this base group
-    destinations = forwarding_config[chat.id]
+    destinations = forwarding_config.get(current_chat_id)
     if not destinations:
         return # No destinations configured for this base group
-        
+
     # We have destinations for this base group!
-    logger.debug(f"Processing message in base group {chat.id} for forwarding to {len(destinations)} destinations")
-    
-    # Forward the message to all destination groups
-    forwarded_count = 0
-    for dest_id in destinations:
-        try:
-            # Check if the user is authenticated before actually forwarding
-            # Get the user ID associated with this base group
-            conn = db.get_db_connection()
-            cursor = conn.cursor()
-            cursor.execute("SELECT user_id FROM users_config WHERE base_group_id = ?", (chat.id,))
-            result = cursor.fetchone()
-            
-            if result:
-                user_id = result['user_id']
-                # Only forward if the user is authenticated
-                if not db.is_user_authenticated(user_id):
-                    logger.warning(f"Skipping forwarding from group {chat.id} to {dest_id} - User {user_id} not authenticated")
-                    continue
-                    
-            # Forward the message (different methods based on type)
-            await context.bot.forward_message(
-                chat_id=dest_id,
-                from_chat_id=chat.id,
-                message_id=message.message_id
-            )
-            forwarded_count += 1
-        except Exception as e:
-            logger.error(f"Failed to forward message {message.message_id} from {chat.id} to {dest_id}: {e}")
-            # TODO: Consider notifying the user who configured this rule if forwarding fails repeatedly?
+    logger.debug("Processing message in base group %s for forwarding to %d destinations", current_chat_id, len(destinations))
 
-    if forwarded_count > 0:
-        logger.info(f"Forwarding completed for message {message.message_id} from {chat.id}. Forwarded: {forwarded_count}")
+    # Queue the message for every destination; each (base, dest) worker batches and forwards
+    # independently, so destinations are still served concurrently
+    message_id = message.message_id
+    for dest_id, copy_messages in destinations:
+        _enqueue_forward(context, current_chat_id, dest_id, copy_messages, message_id)
+
+
+async def handle_my_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Keeps the membership cache in sync when the bot is added to or removed from a chat."""
+    member_update = update.my_chat_member
+    status = member_update.new_chat_member.status
+    context.bot_data.setdefault('member_cache', {})[member_update.chat.id] = (time.monotonic() + _MEMBER_CACHE_TTL, status)
+    logger.info(f"Bot membership in chat {member_update.chat.id} changed to {status}")
 
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Log Errors caused by Updates."""
     logger.error(f"Update {update} caused error {context.error}", exc_info=context.error)
     # Optionally, inform user about the error if it happened during interaction
     if isinstance(update, Update) and update.effective_user:
+        # Only button presses and private messages are interactions worth replying to; group
+        # messages, channel posts or member updates would just produce another (Forbidden) error
+        is_private_message = update.message and update.message.chat.type == constants.ChatType.PRIVATE
+        if not (update.callback_query or is_private_message):
+            return
         user_id = update.effective_user.id
         try:
+             # Apologise and show the main menu again in a single message
              await context.bot.send_message(
                  chat_id=user_id,
-                 text="Ups! Algo salió mal procesando tu solicitud. Lo he registrado. Intenta de nuevo o contacta al administrador si persiste."
-            )
-             # Try showing the main menu again
-             await context.bot.send_message(
-                 chat_id=user_id,
-                 text="Menú Principal:",
-                 reply_markup=get_main_menu_keyboard(user_id)
+                 text="Ups! Algo salió mal procesando tu solicitud. Lo he registrado. Intenta de nuevo o contacta al administrador si persiste.\n\n"
+                      "Menú Principal:",
+                 reply_markup=await _fallback_menu(context, user_id)
              )
              # Reset state just in case
-             db.set_user_state(user_id, 'idle')
+             await async_db.set_user_state(user_id, 'idle')
         except Exception as e:
              logger.error(f"Failed to send error message to user {user_id}: {e}") 
 
@@ -753,7 +1186,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return
     
     # Check if user is authenticated
-    if not db.is_user_authenticated(user_id):
+    if not await is_authenticated(context, user_id):
         await message.reply_text(
             "⚠️ No estás autenticado. Por favor, usa /start e introduce la contraseña de acceso."
         )
@@ -762,5 +1195,5 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     # If user is authenticated, show a reminder of available commands
     await message.reply_text(
         "Para interactuar con el bot, usa los botones del menú principal o el comando /start",
-        reply_markup=get_main_menu_keyboard(user_id)
+        reply_markup=await _main_menu(context, user_id)
     ) 
\ No newline at end of file
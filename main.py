@@ -7,6 +7,7 @@ from telegram.ext import (
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
+    ChatMemberHandler,
     filters,
     ContextTypes,
     ConversationHandler,
@@ -36,7 +37,16 @@ def main() -> None:
 
     logger.info("Creating Telegram Application...")
     # Create the Application and pass it your bot's token.
-    application = Application.builder().token(config.TELEGRAM_BOT_TOKEN).build()
+    # post_init restores the groups/channels seen in previous runs before polling starts.
+    # Updates of different users are processed concurrently so one user's slow request doesn't
+    # hold up everyone else; each user's own updates still run one at a time.
+    application = (
+        Application.builder()
+        .token(config.TELEGRAM_BOT_TOKEN)
+        .post_init(handlers.load_known_chats)
+        .concurrent_updates(handlers.PerUserUpdateProcessor(config.MAX_CONCURRENT_UPDATES))
+        .build()
+    )
 
     # --- Register Handlers ---
     
@@ -72,14 +82,20 @@ def main() -> None:
     #    - Only in groups/supergroups/channels
     #    - Ignore commands (/...) in groups
     #    - Ignore edited messages (can cause issues with forwarding)
+    #    - Non-blocking: forwards are sent by background batch workers, so the
+    #      update loop doesn't have to wait for this handler
     application.add_handler(MessageHandler(
         (filters.ChatType.GROUPS | filters.ChatType.CHANNEL)
         & ~filters.COMMAND
         & ~filters.UpdateType.EDITED_MESSAGE
         & ~filters.UpdateType.EDITED_CHANNEL_POST,
-        handlers.handle_group_message
+        handlers.handle_group_message,
+        block=False
     ))
 
+    # 4. Track the bot's own membership changes (added/removed/kicked)
+    application.add_handler(ChatMemberHandler(handlers.handle_my_chat_member, ChatMemberHandler.MY_CHAT_MEMBER))
+
     # Error Handler
     application.add_error_handler(handlers.error_handler)
 